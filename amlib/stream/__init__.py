@@ -9,7 +9,10 @@
 """ Core stream definitions. """
 
 from amaranth          import *
-from amaranth.lib.fifo import FIFOInterface
+from amaranth.lib.fifo import FIFOInterface, SyncFIFO
+from amaranth.sim      import Settle
+
+from ..test import GatewareTestCase, sync_test_case
 
 class StreamInterface(Record):
     """ Simple record implementing a unidirectional data stream.
@@ -161,3 +164,142 @@ def connect_stream_to_fifo(stream: StreamInterface, fifo: FIFOInterface, firstBi
         result.append(fifo.w_data[lastBit].eq(stream.last))
 
     return result
+
+
+def registered_fifo_ready(m: Module, fifo: FIFOInterface, level: Value=None, domain: str="sync") -> Signal:
+    """Returns a registered ready signal for a stream writing into the FIFO.
+       The FIFO fill level has no combinational path to the upstream producer (ready-then-valid).
+       Ready only stays asserted as long as the FIFO still has room after a write in the current cycle.
+       The fill level defaults to fifo.level, and can be replaced for FIFOs which do not
+       report it in the write domain, or do so with a lag.
+    """
+    if level is None:
+        level = fifo.level
+
+    ready = Signal(reset=1)
+    m.d[domain] += ready.eq(level + fifo.w_en < fifo.depth)
+
+    return ready
+
+
+def connect_stream_burst_to_fifo(m: Module, stream: StreamInterface, fifo: FIFOInterface, *,
+                                 beats: int=2, ready=None, domain: str="sync") -> Signal:
+    """Connects the stream to the input of the FIFO, writing a burst of beats payloads as one FIFO entry.
+       Data flows from the stream to the FIFO. The first beat of a burst is marked by stream.first,
+       and all but the last beat are held in a register, until the last beat writes the whole burst.
+       The first beat occupies the lowest significant bits of the FIFO entry.
+       stream.ready is driven from fifo.w_rdy, unless another ready signal is given.
+       In that case fifo.w_rdy is not checked, so the given ready signal must only
+       be asserted while the FIFO has room for the write of the current burst.
+       Returns a strobe, which is asserted when a burst is restarted before it is complete,
+       or when a beat arrives outside of a burst. Such a beat is dropped.
+    """
+    assert beats >= 2, "use connect_stream_to_fifo() for single beat entries"
+
+    width    = len(stream.payload)
+    buffered = Signal(width * (beats - 1))
+    index    = Signal(range(beats))
+    active   = Signal()
+    beat     = Signal()
+    mismatch = Signal()
+
+    m.d.comb += [
+        stream.ready.eq(fifo.w_rdy if ready is None else ready),
+        beat.eq(stream.valid & stream.ready),
+        fifo.w_data.eq(Cat(buffered, stream.payload)),
+        fifo.w_en.eq(beat & ~stream.first & active & (index == beats - 1)),
+        mismatch.eq(beat & Mux(stream.first, active, ~active)),
+    ]
+
+    with m.If(beat):
+        with m.If(stream.first):
+            m.d[domain] += [
+                buffered[:width].eq(stream.payload),
+                index.eq(1),
+                active.eq(1),
+            ]
+        with m.Elif(active):
+            with m.If(index == beats - 1):
+                m.d[domain] += active.eq(0)
+            with m.Else():
+                m.d[domain] += [
+                    buffered.word_select(index, width).eq(stream.payload),
+                    index.eq(index + 1),
+                ]
+
+    return mismatch
+
+
+class StreamBurstToFIFOTestHarness(Elaboratable):
+    def __init__(self, *, beats):
+        self.beats    = beats
+        self.stream   = StreamInterface()
+        self.fifo     = SyncFIFO(width=8 * beats, depth=4)
+        self.mismatch = Signal()
+
+    def elaborate(self, platform) -> Module:
+        m = Module()
+        m.submodules.fifo = self.fifo
+        m.d.comb += self.mismatch.eq(connect_stream_burst_to_fifo(m, self.stream, self.fifo, beats=self.beats))
+        return m
+
+class StreamBurstToFIFOTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = StreamBurstToFIFOTestHarness
+    FRAGMENT_ARGUMENTS = {'beats': 2}
+
+    def send_beats(self, beats):
+        """ sends the (first, payload) beats and returns the mismatch strobe of each """
+        stream = self.dut.stream
+        mismatches = []
+
+        yield stream.valid.eq(1)
+        for first, payload in beats:
+            yield stream.first.eq(first)
+            yield stream.payload.eq(payload)
+            yield Settle()
+            mismatches.append((yield self.dut.mismatch))
+            yield
+        yield stream.valid.eq(0)
+        yield
+
+        return mismatches
+
+    def read_fifo(self):
+        fifo = self.dut.fifo
+        entries = []
+
+        while (yield fifo.r_rdy):
+            entries.append((yield fifo.r_data))
+            yield fifo.r_en.eq(1)
+            yield
+            yield fifo.r_en.eq(0)
+            yield
+
+        return entries
+
+    @sync_test_case
+    def test_basic(self):
+        mismatches = yield from self.send_beats([
+            (1, 0x11), (0, 0x22),
+            # outside of a burst, dropped
+            (0, 0x33),
+            # the restart drops the incomplete burst
+            (1, 0x44), (1, 0x55), (0, 0x66),
+        ])
+        self.assertEqual(mismatches, [0, 0, 1, 0, 1, 0])
+        self.assertEqual((yield from self.read_fifo()), [0x2211, 0x6655])
+
+class StreamBurstToFIFO3BeatTest(StreamBurstToFIFOTest):
+    FRAGMENT_ARGUMENTS = {'beats': 3}
+
+    @sync_test_case
+    def test_basic(self):
+        mismatches = yield from self.send_beats([
+            (1, 0x01), (0, 0x02), (0, 0x03),
+            # outside of a burst, dropped
+            (0, 0x04),
+            # the restart drops the incomplete burst
+            (1, 0x05), (0, 0x06), (1, 0x07), (0, 0x08), (0, 0x09),
+        ])
+        self.assertEqual(mismatches, [0, 0, 0, 1, 0, 0, 1, 0, 0])
+        self.assertEqual((yield from self.read_fifo()), [0x030201, 0x090807])
@@ -7,13 +7,12 @@ from amaranth import *
 from amaranth.build import Platform
 from amaranth.lib.fifo import SyncFIFO
 
-from . import StreamInterface
-from . import connect_stream_to_fifo
+from . import StreamInterface, registered_fifo_ready
 from ..io.i2c import I2CInitiator, I2CTestbench
 from ..test import GatewareTestCase, sync_test_case
 
 class I2CStreamTransmitter(Elaboratable):
-    def __init__(self, pads, period_cyc, clk_stretch=True, fifo_depth=16):
+    def __init__(self, pads, period_cyc, clk_stretch=True, fifo_depth=16, repeated_start=False):
         self.pads      = pads
         self.stream_in = StreamInterface()
 
@@ -21,58 +20,185 @@ class I2CStreamTransmitter(Elaboratable):
         self._clk_stretch = clk_stretch
         self._fifo_depth  = fifo_depth
 
+        # when enabled, and the next message is already queued at the end of a message,
+        # it is started with a repeated start instead of a stop and a start.
+        # This is off by default, because some devices only commit a write on a stop
+        self._repeated_start = repeated_start
+
         self.i2c = I2CInitiator(self.pads, self._period_cyc, self._clk_stretch)
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
         m.submodules.i2c = i2c = self.i2c
-        m.submodules.input_fifo = in_fifo = SyncFIFO(width=8 + 2, depth=self._fifo_depth)
-        m.d.comb += [
-            connect_stream_to_fifo(self.stream_in, in_fifo),
-            in_fifo.w_data[8].eq(self.stream_in.first),
-            in_fifo.w_data[9].eq(self.stream_in.last),
-        ]
 
-        payload = in_fifo.r_data[:8]
-        first   = in_fifo.r_data[8]
-        last    = in_fifo.r_data[9]
+        # each FIFO entry carries up to four bytes of a message,
+        # a valid flag per byte and the first/last flags of the entry
+        bytes_per_entry = 4
+        data_width      = 8 * bytes_per_entry
+        m.submodules.input_fifo = in_fifo = SyncFIFO(width=data_width + bytes_per_entry + 2, depth=self._fifo_depth)
+
+        stream_ready = registered_fifo_ready(m, in_fifo)
+
+        # the incoming bytes are accumulated until the entry is full
+        # or the last byte of the message arrives, then the entry is written.
+        # The first flag is taken from the first byte of each entry
+        acc_data  = Signal(data_width)
+        acc_valid = Signal(bytes_per_entry)
+        acc_first = Signal()
+        acc_index = Signal(range(bytes_per_entry))
+
+        beat     = Signal()
+        entry    = Signal(data_width)
+        valid    = Signal(bytes_per_entry)
+        is_first = Signal()
 
-        # strobes are low by default
         m.d.comb += [
-            i2c.start.eq(0),
-            i2c.stop.eq(0),
-            i2c.read.eq(0),
-            i2c.write.eq(0),
-            in_fifo.r_en.eq(0),
+            self.stream_in.ready.eq(stream_ready),
+            beat.eq(self.stream_in.valid & stream_ready),
+            entry.eq(acc_data),
+            entry.word_select(acc_index, 8).eq(self.stream_in.payload),
+            valid.eq(acc_valid | (1 << acc_index)),
+            is_first.eq(Mux(acc_index == 0, self.stream_in.first, acc_first)),
+            in_fifo.w_en.eq(beat & (self.stream_in.last | (acc_index == bytes_per_entry - 1))),
+            in_fifo.w_data.eq(Cat(entry, valid, is_first, self.stream_in.last)),
         ]
 
-        with m.FSM():
+        with m.If(in_fifo.w_en):
+            m.d.sync += [
+                acc_valid.eq(0),
+                acc_index.eq(0),
+            ]
+        with m.Elif(beat):
+            m.d.sync += [
+                acc_data.eq(entry),
+                acc_valid.eq(valid),
+                acc_first.eq(is_first),
+                acc_index.eq(acc_index + 1),
+            ]
+
+        # one entry first-word-fall-through skid register between the FIFO read port
+        # and the I2C core. It is refilled in the same cycle its last byte is consumed,
+        # so the next entry is ready without a dead cycle, and the FIFO read mux does not
+        # feed the I2C command logic directly.
+        # The bytes of the entry are serialized by shifting them out of data_r, together
+        # with their valid flags, so that payload_r always is the next byte to send
+        data_r    = Signal(data_width)
+        valid_r   = Signal(bytes_per_entry)
+        first_r   = Signal()
+        last_r    = Signal()
+        payload_r = data_r[:8]
+        consume   = Signal()
+        advance   = Signal()
+        last_byte = Signal()
+
+        with m.If(in_fifo.r_en):
+            m.d.sync += [
+                data_r.eq(in_fifo.r_data[:data_width]),
+                valid_r.eq(in_fifo.r_data[data_width:data_width + bytes_per_entry]),
+                first_r.eq(in_fifo.r_data[-2]),
+                last_r.eq(in_fifo.r_data[-1]),
+            ]
+        with m.Elif(consume):
+            m.d.sync += valid_r.eq(0)
+        with m.Elif(advance):
+            m.d.sync += [
+                data_r.eq(data_r[8:]),
+                valid_r.eq(valid_r[1:]),
+            ]
+
+        # the I2C core ignores stop while it is busy, and prefers stop over
+        # a simultaneous write, so the stop after the last byte of a message
+        # is issued from IDLE, as soon as the core becomes idle again
+        pending_stop = Signal()
+
+        # every strobe is driven by a single expression of the FSM state,
+        # instead of a low default which is overridden inside the FSM
+        idle      = Signal()
+        streaming = Signal()
+        drop      = Signal()
+        restart   = Signal()
+
+        with m.FSM() as fsm:
             with m.State("IDLE"):
-                with m.If(~i2c.busy & in_fifo.r_rdy & first):
-                    m.d.comb += i2c.start.eq(1)
+                with m.If(i2c.stop):
+                    m.d.sync += pending_stop.eq(0)
+                with m.Elif(i2c.start):
+                    m.d.sync += pending_stop.eq(0)
                     m.next = "STREAMING"
 
             with m.State("STREAMING"):
-                with m.If(~i2c.busy):
-                    m.d.comb += [
-                        i2c.data_i.eq(payload),
-                        i2c.write.eq(1),
-                    ]
+                with m.If(i2c.write & last_byte & last_r):
+                    m.d.sync += pending_stop.eq(1)
+                    m.next = "IDLE"
 
-                    with m.If(in_fifo.r_rdy):
-                        m.d.comb += in_fifo.r_en.eq(1)
+        # the next message is already in the skid register, so the
+        # I2C core turns the start into a repeated start condition.
+        # Without repeated starts, restart stays zero and no logic is generated for it
+        if self._repeated_start:
+            m.d.comb += restart.eq(valid_r[0] & first_r)
 
-                    with m.If(last):
-                        m.next = "STOP"
+        m.d.comb += [
+            idle.eq(fsm.ongoing("IDLE") & ~i2c.busy),
+            streaming.eq(fsm.ongoing("STREAMING") & ~i2c.busy),
+            i2c.stop.eq(idle & pending_stop & ~restart),
+            i2c.start.eq(idle & valid_r[0] & first_r & (~pending_stop | restart)),
+            # drop entries which do not start a packet
+            drop.eq(idle & ~pending_stop & valid_r[0] & ~first_r),
+            i2c.write.eq(streaming & valid_r[0]),
+            i2c.read.eq(0),
+            i2c.data_i.eq(payload_r),
 
-            with m.State("STOP"):
-                with m.If(~i2c.busy):
-                    m.d.comb += i2c.stop.eq(1)
-                    m.next = "IDLE"
+            last_byte.eq(~valid_r[1]),
+            consume.eq(drop | (i2c.write & last_byte)),
+            advance.eq(i2c.write & ~last_byte),
+            in_fifo.r_en.eq(in_fifo.r_rdy & (~valid_r[0] | consume)),
+        ]
 
         return m
 
 
+def transmit_i2c_stream(dut: I2CStreamTransmitter, messages, *, stall=False, idle_cycles=200):
+    """ sends the messages through the stream, and records the commands issued to the I2C core
+        until it has been idle for idle_cycles. With stall set, valid is only asserted
+        every third cycle. Returns a list of "S", "P" and the bytes written
+    """
+    stream = dut.stream_in
+    i2c    = dut.i2c
+    beats  = [(byte, index == 0, index == len(message) - 1)
+              for message in messages for index, byte in enumerate(message)]
+
+    commands = []
+    cycle    = 0
+    idle     = 0
+    while beats or idle < idle_cycles:
+        offer = len(beats) > 0 and not (stall and cycle % 3 != 0)
+        if offer:
+            payload, first, last = beats[0]
+            yield stream.payload.eq(payload)
+            yield stream.first.eq(first)
+            yield stream.last.eq(last)
+        yield stream.valid.eq(offer)
+        yield
+
+        if offer and (yield stream.ready):
+            beats.pop(0)
+
+        idle += 1
+        if not (yield i2c.busy):
+            if (yield i2c.start):
+                commands.append("S")
+                idle = 0
+            if (yield i2c.write):
+                commands.append((yield i2c.data_i))
+                idle = 0
+            if (yield i2c.stop):
+                commands.append("P")
+                idle = 0
+        cycle += 1
+
+    return commands
+
+
 class I2CStreamTransmitterTest(GatewareTestCase):
     FRAGMENT_UNDER_TEST = I2CStreamTransmitter
     FRAGMENT_ARGUMENTS = {'pads': I2CTestbench(), 'period_cyc': 4, 'clk_stretch': False, }
@@ -101,4 +227,62 @@ class I2CStreamTransmitterTest(GatewareTestCase):
         yield
         yield
         yield
-        for _ in range(330): yield
\ No newline at end of file
+        for _ in range(330): yield
+
+    @sync_test_case
+    def test_stop_between_messages(self):
+        commands = yield from transmit_i2c_stream(self.dut, [[0x01, 0x02], [0x03], [0x04, 0x05, 0x06]])
+        self.assertEqual(commands, ["S", 0x01, 0x02, "P", "S", 0x03, "P", "S", 0x04, 0x05, 0x06, "P"])
+
+    # 1 and 5 bytes leave a partial entry, 4 bytes fill exactly one entry,
+    # 5 and 9 bytes are split across FIFO entries
+    _MESSAGES = [
+        [0x11],
+        [0x21, 0x22, 0x23, 0x24],
+        [0x31, 0x32, 0x33, 0x34, 0x35],
+        [0x41, 0x42, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49],
+    ]
+
+    def expected_commands(self, messages):
+        return [command for message in messages for command in ["S", *message, "P"]]
+
+    @sync_test_case
+    def test_message_lengths(self):
+        commands = yield from transmit_i2c_stream(self.dut, self._MESSAGES)
+        self.assertEqual(commands, self.expected_commands(self._MESSAGES))
+
+    @sync_test_case
+    def test_message_lengths_stalled(self):
+        commands = yield from transmit_i2c_stream(self.dut, self._MESSAGES, stall=True)
+        self.assertEqual(commands, self.expected_commands(self._MESSAGES))
+
+    @sync_test_case
+    def test_single_messages(self):
+        for message in self._MESSAGES:
+            commands = yield from transmit_i2c_stream(self.dut, [message])
+            self.assertEqual(commands, self.expected_commands([message]))
+
+    @sync_test_case
+    def test_fifo_full(self):
+        # more entries than the FIFO holds, so stream_in.ready has to throttle the message
+        messages = [[(i * 37 + 5) & 0xff for i in range(80)], [0x01, 0x02]]
+        commands = yield from transmit_i2c_stream(self.dut, messages)
+        self.assertEqual(commands, self.expected_commands(messages))
+
+
+class I2CStreamTransmitterRepeatedStartTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = I2CStreamTransmitter
+    FRAGMENT_ARGUMENTS = {'pads': I2CTestbench(), 'period_cyc': 4, 'clk_stretch': False, 'repeated_start': True}
+
+    @sync_test_case
+    def test_repeated_start(self):
+        commands = yield from transmit_i2c_stream(self.dut, [[0x01, 0x02], [0x03], [0x04, 0x05, 0x06]])
+        self.assertEqual(commands, ["S", 0x01, 0x02, "S", 0x03, "S", 0x04, 0x05, 0x06, "P"])
+
+    @sync_test_case
+    def test_stop_when_idle(self):
+        # the next message is only queued after the stop has been sent
+        commands = yield from transmit_i2c_stream(self.dut, [[0x01, 0x02]])
+        self.assertEqual(commands, ["S", 0x01, 0x02, "P"])
+        commands = yield from transmit_i2c_stream(self.dut, [[0x03]])
+        self.assertEqual(commands, ["S", 0x03, "P"])
@@ -10,7 +10,18 @@ python3 -m unittest amlib.io.spi.SPIControllerInterfaceTest
 python3 -m unittest amlib.io.spi.SPIDeviceInterfaceTest
 python3 -m unittest amlib.io.spi.SPIRegisterInterfaceTest
 python3 -m unittest amlib.io.i2s.I2STransmitterTest
+python3 -m unittest amlib.io.i2s.I2STransmitterLeftJustifiedTest
+python3 -m unittest amlib.io.i2s.I2STransmitter16BitTest
+python3 -m unittest amlib.io.i2s.I2STransmitter16BitLeftJustifiedTest
+python3 -m unittest amlib.io.i2s.I2STransmitter32BitTest
+python3 -m unittest amlib.io.i2s.I2STransmitter32BitLeftJustifiedTest
+python3 -m unittest amlib.io.i2s.I2STransmitterStatusTest
+python3 -m unittest amlib.io.i2s.I2STransmitterFIFODepthTest
+python3 -m unittest amlib.io.i2s.I2STransmitterResetTest
+python3 -m unittest amlib.io.i2s.I2SReceiverTest
 python3 -m unittest amlib.io.i2s.I2SLoopbackTest
+python3 -m unittest amlib.io.i2s.I2SLoopbackLeftJustifiedTest
+python3 -m unittest amlib.io.i2s.I2SLoopback32BitLeftJustifiedTest
 python3 -m unittest amlib.io.max7219.SerialLEDArrayTest
 python3 -m unittest amlib.io.led.NumberToBitBarTest
 
@@ -21,7 +32,10 @@ python3 -m unittest amlib.dsp.fixedpointcicfilter.FixedPointCICFilterTest
 python3 -m unittest amlib.dsp.resampler.ResamplerTestFIR
 python3 -m unittest amlib.dsp.resampler.ResamplerTestIIR
 
+python3 -m unittest amlib.stream.StreamBurstToFIFOTest
+python3 -m unittest amlib.stream.StreamBurstToFIFO3BeatTest
 python3 -m unittest amlib.stream.i2c.I2CStreamTransmitterTest
+python3 -m unittest amlib.stream.i2c.I2CStreamTransmitterRepeatedStartTest
 python3 -m unittest amlib.stream.uart.UARTTransmitterTest
 python3 -m unittest amlib.stream.uart.UARTMultibyteTransmitterTest
 python3 -m unittest amlib.stream.generator.ConstantStreamGeneratorTest